@@ -15,56 +15,100 @@ Cite CLASS paper:
  D. Blas, J. Lesgourgues, T. Tram, arXiv:1104.2933 [astro-ph.CO], JCAP 1107 (2011) 034
 Call with:
     python make_class_power.py <MP-GenIC parameter file> <external power spectrum file>
-    where the second external power spectrum file is optional and is a primordial power spectrum for CLASS."""
+    where the second external power spectrum file is optional and is a primordial power spectrum for CLASS.
+    With --binary the tables are saved with numpy.save to <file>.npy instead.
+    These are for python analysis: MP-GenIC only reads the text format."""
 
 from __future__ import print_function
-import math
 import os.path
+import re
 import argparse
+import collections
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import classylss
 import classylss.binding as CLASS
-import configobj
-import validate
-
-GenICconfigspec = """
-FileWithInputSpectrum = string(default='')
-FileWithTransferFunction = string(default='')
-Ngrid = integer(min=0)
-BoxSize = float(min=0)
-Omega0 = float(0,1)
-OmegaLambda = float(0,1)
-OmegaBaryon = float(0,1,default=0.0486)
-HubbleParam = float(0,2)
-Redshift = float(0,1100)
-Sigma8 = float(default=-1)
-InputPowerRedshift = float(default=-1)
-DifferentTransferFunctions = integer(0,1, default=1)
-UnitLength_in_cm  = float(default=3.085678e21)
-Omega_fld = float(0,1,default=0)
-w0_fld = float(default=-1)
-wa_fld = float(default=0)
-MNue = float(min=0, default=0)
-MNum = float(min=0, default=0)
-MNut = float(min=0, default=0)
-MWDM_Therm = float(min=0, default=0)
-PrimordialIndex = float(default=0.971)
-PrimordialAmp = float(default=2.215e-9)
-PrimordialRunning = float(default=0)
-CMBTemperature = float(default=2.7255)""".split('\n')
+
+#The MP-GenIC parameters used here: name = (type, default, (min, max)).
+#A default of None means the parameter is required. A bound of None means no limit.
+GenICparams = {
+    'FileWithInputSpectrum': (str, '', None),
+    'FileWithTransferFunction': (str, '', None),
+    'Ngrid': (int, None, (0, None)),
+    'BoxSize': (float, None, (0, None)),
+    'Omega0': (float, None, (0, 1)),
+    'OmegaLambda': (float, None, (0, 1)),
+    'OmegaBaryon': (float, 0.0486, (0, 1)),
+    'HubbleParam': (float, None, (0, 2)),
+    'Redshift': (float, None, (0, 1100)),
+    'Sigma8': (float, -1., None),
+    'InputPowerRedshift': (float, -1., None),
+    'DifferentTransferFunctions': (int, 1, (0, 1)),
+    'UnitLength_in_cm': (float, 3.085678e21, None),
+    'Omega_fld': (float, 0., (0, 1)),
+    'w0_fld': (float, -1., None),
+    'wa_fld': (float, 0., None),
+    'MNue': (float, 0., (0, None)),
+    'MNum': (float, 0., (0, None)),
+    'MNut': (float, 0., (0, None)),
+    'MWDM_Therm': (float, 0., (0, None)),
+    'PrimordialIndex': (float, 0.971, None),
+    'PrimordialAmp': (float, 2.215e-9, None),
+    'PrimordialRunning': (float, 0., None),
+    'CMBTemperature': (float, 2.7255, None),
+}
+
+#A parameter line: the name, then blanks or '=', then the value.
+_param_line = re.compile(r'\s*([^\s=]+)[\s=]*(.*)')
+
+def _parse_genic(paramfile):
+    """Read the parameters in GenICparams from an MP-GenIC parameter file.
+    The format is that read by MP-GenIC: one 'name = value' per line,
+    with anything after a '#' or '%' a comment. Other parameters are ignored.
+    Returns a dictionary of each parameter, converted to its type and checked
+    against its bounds, or set to its default if not present."""
+    values = {}
+    with open(paramfile) as pf:
+        for lineno, line in enumerate(pf, 1):
+            line = re.split('[#%]', line, 1)[0].strip()
+            if line == '':
+                continue
+            name, value = _param_line.match(line).groups()
+            if value == '':
+                raise ValueError("Line %d of %s is malformed: %s" % (lineno, paramfile, line))
+            values[name] = value
+    config = {}
+    for name, (kind, default, bounds) in GenICparams.items():
+        if name not in values:
+            if default is None:
+                raise ValueError("Required parameter %s not set in %s" % (name, paramfile))
+            config[name] = default
+            continue
+        value = values[name]
+        if kind is str:
+            #Strip matched quotes
+            if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+                value = value[1:-1]
+        else:
+            try:
+                value = kind(value)
+            except ValueError:
+                raise ValueError("Parameter %s = %s is not of type %s" % (name, value, kind.__name__))
+        if bounds is not None:
+            (lo, hi) = bounds
+            if (lo is not None and value < lo) or (hi is not None and value > hi):
+                raise ValueError("Parameter %s = %s is outside [%s, %s]" % (name, value, lo, hi))
+        config[name] = value
+    return config
 
 def _check_genic_config(config):
     """Check that the MP-GenIC config file is sensible for running CLASS on."""
-    vtor = validate.Validator()
-    config.validate(vtor)
     filekeys = ['FileWithInputSpectrum', ]
     if config['DifferentTransferFunctions'] == 1.:
         filekeys += ['FileWithTransferFunction',]
     for ff in filekeys:
         if config[ff] == '':
-            raise IOError("No savefile specified for ",ff)
-        if os.path.exists(config[ff]):
-            raise IOError("Refusing to write to existing file: ",config[ff])
+            raise IOError("No savefile specified for %s" % ff)
 
     #Check unsupported configurations
     if config['MWDM_Therm'] > 0:
@@ -75,29 +119,32 @@ def _check_genic_config(config):
 
 def _build_cosmology_params(config):
     """Build a correctly-named-for-class set of cosmology parameters from the MP-GenIC config file."""
+    #The parameters used here.
+    cfg = {k: config[k] for k in ('HubbleParam', 'Omega0', 'OmegaLambda', 'OmegaBaryon', 'MNue', 'MNum', 'MNut', 'PrimordialIndex', 'PrimordialRunning', 'PrimordialAmp', 'CMBTemperature', 'Omega_fld', 'w0_fld', 'wa_fld', 'Sigma8')}
     #Class takes omega_m h^2 as parameters
-    h0 = config['HubbleParam']
-    omeganu = (config['MNue'] + config['MNum'] + config['MNut'])/93.14/h0**2
-    if config['OmegaBaryon'] < 0.001:
-        config['OmegaBaryon'] = 0.0486
-    ocdm = config['Omega0'] - config['OmegaBaryon'] - omeganu
+    h0 = cfg['HubbleParam']
+    mnu = (cfg['MNue'], cfg['MNum'], cfg['MNut'])
+    omeganu = sum(mnu)/93.14/h0**2
+    omegab = cfg['OmegaBaryon']
+    if omegab < 0.001:
+        omegab = 0.0486
+    ocdm = cfg['Omega0'] - omegab - omeganu
 
-    omegak = 1-config['OmegaLambda']-config['Omega0']
+    omegak = 1-cfg['OmegaLambda']-cfg['Omega0']
     # avoid numerical issue due to very small OmegaK
     if np.abs(omegak) < 1e-9:
         omegak = 0
 
-    gparams = {'h':config['HubbleParam'], 'Omega_cdm':ocdm,'Omega_b':config['OmegaBaryon'], 'Omega_k':omegak, 'n_s': config['PrimordialIndex'], 'alpha_s': config['PrimordialRunning'],'T_cmb':config["CMBTemperature"]}
     #One may specify either OmegaLambda or Omega_fld,
     #and the other is worked out by summing all matter to unity.
     #Specify Omega_fld even if we have Lambda, to avoid floating point.
-    gparams['Omega_fld'] = config['Omega_fld']
-    if config['Omega_fld'] > 0:
-        gparams['w0_fld'] = config['w0_fld']
-        gparams['wa_fld'] = config['wa_fld']
+    gparams = {'h':h0, 'Omega_cdm':ocdm,'Omega_b':omegab, 'Omega_k':omegak, 'n_s': cfg['PrimordialIndex'], 'alpha_s': cfg['PrimordialRunning'],'T_cmb':cfg["CMBTemperature"], 'Omega_fld': cfg['Omega_fld'], 'A_s': cfg["PrimordialAmp"]}
+    if cfg['Omega_fld'] > 0:
+        gparams['w0_fld'] = cfg['w0_fld']
+        gparams['wa_fld'] = cfg['wa_fld']
     #Set up massive neutrinos
     if omeganu > 0:
-        gparams['m_ncdm'] = '%.8f,%.8f,%.8f' % (config['MNue'], config['MNum'], config['MNut'])
+        gparams['m_ncdm'] = '%.8f,%.8f,%.8f' % mnu
         gparams['N_ncdm'] = 3
         gparams['N_ur'] = 0.00641
         #Neutrino accuracy: Default pk_ref.pre has tol_ncdm_* = 1e-10,
@@ -116,12 +163,38 @@ def _build_cosmology_params(config):
     else:
         gparams['N_ur'] = 3.046
     #Power spectrum amplitude: sigma8 is ignored by classylss.
-    if config['Sigma8'] > 0:
+    if cfg['Sigma8'] > 0:
         print("Warning: classylss does not read sigma8. GenIC must rescale P(k).")
-    gparams['A_s'] = config["PrimordialAmp"]
     return gparams
 
-def make_class_power(paramfile, external_pk = None, extraz=None, verbose=False):
+#CLASS engines already built in this process, keyed by their frozen parameters,
+#so that repeated calls with the same cosmology skip the Boltzmann solve.
+_ENGINE_CACHE = collections.OrderedDict()
+_ENGINE_CACHE_SIZE = 8
+
+def _freeze_params(params):
+    """Convert a dictionary of CLASS parameters to a hashable key."""
+    def _freeze(value):
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return tuple(value)
+        return value
+    return tuple(sorted((k, _freeze(v)) for k, v in params.items()))
+
+def _get_engine(pre_params):
+    """Get a CLASS engine and its Spectra for a set of CLASS parameters.
+    The result is cached, least recently used first out, so identical parameters reuse the engine."""
+    key = _freeze_params(pre_params)
+    try:
+        engine, powspec = _ENGINE_CACHE.pop(key)
+    except KeyError:
+        engine = CLASS.ClassEngine(pre_params)
+        powspec = CLASS.Spectra(engine)
+        if len(_ENGINE_CACHE) >= _ENGINE_CACHE_SIZE:
+            _ENGINE_CACHE.popitem(last=False)
+    _ENGINE_CACHE[key] = (engine, powspec)
+    return engine, powspec
+
+def make_class_power(paramfile, external_pk = None, extraz=None, verbose=False, binary=False):
     """Main routine: parses a parameter file and makes a matter power spectrum.
     Will not over-write power spectra if already present.
     Options are loaded from the MP-GenIC parameter file.
@@ -137,8 +210,11 @@ def make_class_power(paramfile, external_pk = None, extraz=None, verbose=False):
 
     Not supported:
         - Warm dark matter power spectra.
-        - Rescaling with different transfer functions."""
-    config = configobj.ConfigObj(infile=paramfile, configspec=GenICconfigspec, file_error=True)
+        - Rescaling with different transfer functions.
+
+    If binary is True, tables are saved with numpy.save to <file>.npy,
+    which MP-GenIC cannot read."""
+    config = _parse_genic(paramfile)
     #Input sanitisation
     _check_genic_config(config)
 
@@ -153,16 +229,30 @@ def make_class_power(paramfile, external_pk = None, extraz=None, verbose=False):
     redshift = config['Redshift']
     if config['InputPowerRedshift'] >= 0:
         redshift = config['InputPowerRedshift']
-    outputs = redshift
-    if extraz is not None:
-        outputs = [outputs,]+ extraz
+    extra = [] if extraz is None else list(extraz)
+    outputs = np.fromiter([redshift,] + extra, dtype=np.float64, count=1+len(extra))
+    #Save directory
+    sdir = os.path.split(paramfile)[0]
+    pkfile = os.path.join(sdir, config['FileWithInputSpectrum'])
+    tfile = os.path.join(sdir, config['FileWithTransferFunction'])
+    #File name suffix for each output redshift
+    suffixes = ['',] + ["-"+str(red) for red in extra]
+    #Check all output files at once, so we fail before running CLASS.
+    targets = [pkfile+ss for ss in suffixes] + [tfile+ss for ss in suffixes[1:]]
+    if config['DifferentTransferFunctions'] == 1.:
+        targets.append(tfile)
+    if binary:
+        targets = [ff+'.npy' for ff in targets]
+    existing = [ff for ff in targets if os.path.exists(ff)]
+    if existing:
+        raise IOError("Refusing to write to existing files: %s" % ", ".join(existing))
     #Pass options for the power spectrum
     MPC_in_cm = 3.085678e24
     boxmpc = config['BoxSize'] / MPC_in_cm * config['UnitLength_in_cm']
-    maxk = max(10, 2*math.pi/boxmpc*config['Ngrid']*4)
+    maxk = max(10, 2*np.pi*config['Ngrid']*4/boxmpc)
     #CLASS needs the first redshift to be relatively high for some internal interpolation reasons
     maxz = max(1 + np.max(outputs), 99)
-    powerparams = {'output': 'dTk vTk mPk', 'P_k_max_h/Mpc' : maxk, "z_max_pk" : maxz,'z_pk': outputs, 'extra metric transfer functions': 'y'}
+    powerparams = {'output': 'dTk vTk mPk', 'P_k_max_h/Mpc' : maxk, "z_max_pk" : maxz,'z_pk': list(outputs), 'extra metric transfer functions': 'y'}
     pre_params.update(powerparams)
 
     if verbose:
@@ -183,46 +273,59 @@ def make_class_power(paramfile, external_pk = None, extraz=None, verbose=False):
         print('Starting CLASS power spectrum with accurate P(k) for massive neutrinos.')
         print('Computation may take several minutes')
     #Make the power spectra module
-    engine = CLASS.ClassEngine(pre_params)
-    powspec = CLASS.Spectra(engine)
+    engine, powspec = _get_engine(pre_params)
     print("sigma_8(z=0) = ", powspec.sigma8, "A_s = ",powspec.A_s)
-    #Save directory
-    sdir = os.path.split(paramfile)[0]
-    #Get and save the transfer functions if needed
-    trans = powspec.get_transfer(z=redshift)
-    if config['DifferentTransferFunctions'] == 1.:
-        tfile = os.path.join(sdir, config['FileWithTransferFunction'])
-        if os.path.exists(tfile):
-            raise IOError("Refusing to write to existing file: ",tfile)
-        save_transfer(trans, tfile)
-    #fp-roundoff
-    trans['k'][-1] *= 0.9999
-    #Get and save the matter power spectrum
-    pk_lin = powspec.get_pklin(k=trans['k'], z=redshift)
-    pkfile = os.path.join(sdir, config['FileWithInputSpectrum'])
-    if os.path.exists(pkfile):
-        raise IOError("Refusing to write to existing file: ",pkfile)
-    np.savetxt(pkfile, np.vstack([trans['k'], pk_lin]).T)
-    if extraz is not None:
-        for red in extraz:
-            trans = powspec.get_transfer(z=red)
-            tfile = os.path.join(sdir, config['FileWithTransferFunction']+"-"+str(red))
-            if os.path.exists(tfile):
-                raise IOError("Refusing to write to existing file: ",tfile)
-            save_transfer(trans, tfile)
-            trans['k'][-1] *= 0.9999
-            #Get and save the matter power spectrum
-            pk_lin = powspec.get_pklin(k=trans['k'], z=red)
-            pkfile = os.path.join(sdir, config['FileWithInputSpectrum']+"-"+str(red))
-            if os.path.exists(pkfile):
-                raise IOError("Refusing to write to existing file: ",pkfile)
-            np.savetxt(pkfile, np.vstack([trans['k'], pk_lin]).T)
-
-def save_transfer(transfer, transferfile):
-    """Save a transfer function. Note we save the CLASS FORMATTED transfer functions.
-    The transfer functions differ from CAMB by:
-        T_CAMB(k) = -T_CLASS(k)/k^2 """
-    header="""Transfer functions T_i(k) for adiabatic (AD) mode (normalized to initial curvature=1)
+    #CLASS is queried from this thread only, as classylss does not promise to be
+    #thread-safe. Files are written from a worker thread, so writing the
+    #tables for one redshift overlaps with the CLASS query for the next.
+    pool = ThreadPool(1)
+    writes = []
+    try:
+        #The CLASS k grid does not depend on redshift, so take it once
+        #from the first transfer function and reuse it for every output.
+        #Later redshifts only query CLASS for their transfer functions.
+        trans = powspec.get_transfer(z=outputs[0])
+        #fp-roundoff. Copy as the transfer function may still be being written.
+        k = trans['k'].copy()
+        k[-1] *= 0.9999
+        #Get the matter power spectrum at all outputs in one call.
+        pk_lin = powspec.get_pklin(k=k[np.newaxis,:], z=outputs[:,np.newaxis])
+        #Contiguous (k, P(k)) table for each output.
+        pktables = np.empty((outputs.size, k.size, 2), dtype=np.float64)
+        pktables[:,:,0] = k
+        pktables[:,:,1] = pk_lin
+        for i, ss in enumerate(suffixes):
+            if i > 0:
+                trans = powspec.get_transfer(z=outputs[i])
+            #Save the transfer functions if needed
+            transfile = tfile+ss
+            if i == 0 and config['DifferentTransferFunctions'] != 1.:
+                transfile = None
+            writes += _save_outputs(pool, trans, transfile, pktables[i], pkfile+ss, binary=binary)
+        #Re-raise any error from the writes
+        for ww in writes:
+            ww.get()
+    finally:
+        pool.close()
+        pool.join()
+
+def _save_outputs(pool, trans, transfile, pktable, pkfile, binary=False):
+    """Queue saving the tables for one redshift on the thread pool: the transfer function,
+    unless transfile is None, and the matter power spectrum. Returns the pending writes."""
+    writes = []
+    if transfile is not None:
+        writes.append(pool.apply_async(save_transfer, (trans, transfile), {'binary': binary}))
+    writes.append(pool.apply_async(save_power, (pktable, pkfile), {'binary': binary}))
+    return writes
+
+def save_power(pktable, pkfile, binary=False):
+    """Save a (k, P(k)) table as text, or if binary is True unformatted to pkfile.npy."""
+    if binary:
+        np.save(pkfile+'.npy', pktable)
+    else:
+        np.savetxt(pkfile, pktable)
+
+_transfer_header = """Transfer functions T_i(k) for adiabatic (AD) mode (normalized to initial curvature=1)
 d_i   stands for (delta rho_i/rho_i)(k,z) with above normalization
 d_tot stands for (delta rho_tot/rho_tot)(k,z) with rho_Lambda NOT included in rho_tot
 (note that this differs from the transfer function output from CAMB/CMBFAST, which gives the same
@@ -231,8 +334,24 @@ t_i   stands for theta_i(k,z) with above normalization
 t_tot stands for (sum_i [rho_i+p_i] theta_i)/(sum_i [rho_i+p_i]))(k,z)
 If some neutrino species are massless, or degenerate, the d_ncdm and t_ncdm columns may be missing below.
 1:k (h/Mpc)              2:d_g                    3:d_b                    4:d_cdm                  5:d_ur        6:d_ncdm[0]              7:d_ncdm[1]              8:d_ncdm[2]              9:d_tot                 10:phi     11:psi                   12:h                     13:h_prime               14:eta                   15:eta_prime     16:t_g                   17:t_b                   18:t_ur        19:t_ncdm[0]             20:t_ncdm[1]             21:t_ncdm[2]             22:t_tot"""
-    #This format matches the default output by CLASS command line.
-    np.savetxt(transferfile, transfer, header=header)
+#Header for the transfer function file, formatted as a comment as numpy.savetxt would.
+_transfer_header_bytes = ('# ' + _transfer_header.replace('\n', '\n# ') + '\n').encode()
+
+def save_transfer(transfer, transferfile, binary=False):
+    """Save a transfer function. Note we save the CLASS FORMATTED transfer functions.
+    The transfer functions differ from CAMB by:
+        T_CAMB(k) = -T_CLASS(k)/k^2
+    If binary is True, the table is instead saved unformatted to transferfile.npy.
+    MP-GenIC only reads the ASCII format, so this is for python post-processing."""
+    if binary:
+        np.save(transferfile+'.npy', transfer)
+        return
+    #This format matches the default output by CLASS command line,
+    #which prints 12 significant digits. A single format string
+    #avoids per-column format detection and writes are buffered.
+    with open(transferfile, 'wb', buffering=1<<20) as tf:
+        tf.write(_transfer_header_bytes)
+        np.savetxt(tf, transfer, fmt='%.12e')
 
 if __name__ ==  "__main__":
     parser = argparse.ArgumentParser()
@@ -240,5 +359,6 @@ if __name__ ==  "__main__":
     parser.add_argument('--extpk', type=str, help='optional external primordial power spectrum',required=False)
     parser.add_argument('--extraz', type=float,nargs='*', help='Space separated list of other redshifts at which to output power spectra',required=False)
     parser.add_argument('--verbose', action='store_true', help='print class runtime information',required=False)
+    parser.add_argument('--binary', action='store_true', help='save tables as numpy .npy files, not readable by MP-GenIC',required=False)
     args = parser.parse_args()
-    make_class_power(args.paramfile, args.extpk, args.extraz,args.verbose)
+    make_class_power(args.paramfile, args.extpk, args.extraz,args.verbose, args.binary)